@@ -1,16 +1,18 @@
 from __future__ import annotations
 
 import streamlit as st
-import streamlit.components.v1 as components
-import yaml
 from pathlib import Path
+import copy
 import tempfile
+import threading
 import shutil
-from typing import Optional, List, Dict, Set
-from contextlib import contextmanager
+from collections import OrderedDict
+from typing import Optional, List, Dict, FrozenSet, Set, Tuple
+from concurrent.futures import ThreadPoolExecutor
 
+from core.config_lib import load_config
 from core.merge_geojson_lib import merge_geojson
-from core.csv_to_geojson_lib import batch_csv_to_geojson
+from core.csv_to_geojson_lib import batch_csv_to_geojson, list_csv_files
 from core.extract_embedded_lib import extract_embedded
 
 
@@ -26,11 +28,13 @@ st.set_page_config(
 
 APP_DIR = Path(__file__).resolve().parent
 CFG_PATH = APP_DIR / "config.yaml"
+DEFAULT_INPUT = str(APP_DIR / "Input")
+DEFAULT_OUTPUT = str(APP_DIR / "Output")
 
 DEFAULTS = {
     "defaults": {
-        "input_folder": str(APP_DIR / "Input"),
-        "output_folder": str(APP_DIR / "Output"),
+        "input_folder": DEFAULT_INPUT,
+        "output_folder": DEFAULT_OUTPUT,
         "default_country": "NZ",
     }
 }
@@ -40,17 +44,16 @@ DEFAULTS = {
 # Config handling
 # -----------------------------------------------------------------------------
 
-def load_config(path: Path, defaults: dict) -> dict:
-    if not path.exists():
-        return defaults
-    try:
-        data = yaml.safe_load(path.read_text(encoding="utf-8")) or {}
-        return {**defaults, **data}
-    except Exception:
-        return defaults
+@st.cache_data(show_spinner=False)
+def _load_cfg(path: str, mtime: float) -> dict:
+    # mtime is only part of the cache key, so edits to config.yaml are picked up
+    return load_config(Path(path), DEFAULTS)
 
 
-CFG = load_config(CFG_PATH, DEFAULTS)
+CFG = _load_cfg(
+    str(CFG_PATH),
+    CFG_PATH.stat().st_mtime if CFG_PATH.exists() else 0.0,
+)
 
 
 def cfg_get(tool: str, key: str, fallback: str) -> str:
@@ -62,97 +65,197 @@ def cfg_get(tool: str, key: str, fallback: str) -> str:
 
 
 # -----------------------------------------------------------------------------
-# Helpers
+# Processor registry
 # -----------------------------------------------------------------------------
 
-def save_uploaded_files(uploaded_files, dest: Path) -> List[Path]:
-    dest.mkdir(parents=True, exist_ok=True)
-    saved: List[Path] = []
-    for upload in uploaded_files:
-        target = dest / upload.name
-        target.write_bytes(upload.read())
-        saved.append(target)
-    return saved
+PROCESSORS: Dict[str, Set[str]] = {
+    "merge_geojson": {".geojson"},
+    "csv_to_geojson": {".csv"},
+    "extract_embedded": {".xlsx", ".zip"},
+}
+
+# Uploads are saved into one subfolder per processor, so each processor only
+# walks its own files
+PROCESSOR_FOR_EXT: Dict[str, str] = {
+    ext: name for name, exts in PROCESSORS.items() for ext in exts
+}
 
 
-@contextmanager
-def temp_dir(prefix: str = "eudr_"):
-    p = Path(tempfile.mkdtemp(prefix=prefix))
-    try:
-        yield p
-    finally:
-        shutil.rmtree(p, ignore_errors=True)
+def pick_processors(exts: FrozenSet[str]) -> Tuple[str, ...]:
+    return tuple(name for name, proc_exts in PROCESSORS.items() if exts & proc_exts)
 
 
 # -----------------------------------------------------------------------------
-# Responsive helper (safe)
+# Helpers
 # -----------------------------------------------------------------------------
 
-_WIDTH_JS = """
-<script>
-(function(){
-  const param = '_sw';
-  const w = window.innerWidth || document.documentElement.clientWidth;
-  const url = new URL(window.location);
-  if (url.searchParams.get(param) !== String(w)) {
-    url.searchParams.set(param, String(w));
-    window.location.replace(url.toString());
-  }
-})();
-</script>
-"""
+COPY_BUFSIZE = 1 << 20
 
 
-def inject_width_tracker():
-    components.html(_WIDTH_JS, height=0)
+def upload_target(upload, dest: Path) -> Path:
+    sub = PROCESSOR_FOR_EXT.get(Path(upload.name).suffix.lower())
+    return (dest / sub if sub else dest) / upload.name
 
 
-def get_client_width() -> Optional[int]:
-    v = st.query_params.get("_sw")
-    try:
-        return int(v[0] if isinstance(v, list) else v)
-    except Exception:
-        return None
+def _write_upload(upload, target: Path) -> Path:
+    target.parent.mkdir(exist_ok=True)
+    upload.seek(0)
+    with target.open("wb") as dst:
+        shutil.copyfileobj(upload, dst, min(upload.size, COPY_BUFSIZE))
+    return target
 
 
-def quick_layout(width: Optional[int]) -> List[float]:
-    # Always 3 columns — only ratios change
-    if not width:
-        return [1.2, 1.2, 1.6]
-    if width < 1000:
-        return [1.0, 1.0, 1.4]
-    if width < 1400:
-        return [1.4, 1.2, 2.0]
-    return [1.8, 1.4, 2.6]
+def save_uploaded_files(
+    uploaded_files,
+    dest: Path,
+    saved_ids: Optional[Dict[str, str]] = None,
+) -> List[Path]:
+    """
+    Write uploads below dest and return their paths.
+    saved_ids (target path -> upload file_id) carries state between calls on
+    the same dest: unchanged uploads are not rewritten and files whose upload
+    was removed are deleted.
+    """
+    dest.mkdir(parents=True, exist_ok=True)
+    saved_ids = {} if saved_ids is None else saved_ids
+    # A file dropped twice maps to the same target; write it once. For a repeated
+    # name the last upload wins, as it did when files were written in sequence.
+    targets = {str(upload_target(u, dest)): u for u in uploaded_files or []}
+
+    for old in [t for t in saved_ids if t not in targets]:
+        Path(old).unlink(missing_ok=True)
+        del saved_ids[old]
+
+    pending = [
+        (u, Path(t)) for t, u in targets.items()
+        if not (u.file_id == saved_ids.get(t) and Path(t).exists())
+    ]
+    if pending:
+        # Writes are independent and I/O bound
+        with ThreadPoolExecutor(max_workers=min(8, len(pending))) as ex:
+            list(ex.map(lambda job: _write_upload(*job), pending))
+        for u, t in pending:
+            saved_ids[str(t)] = u.file_id
+
+    return [Path(t) for t in targets]
+
+
+def csv_batch_signature(in_dir: Path) -> tuple:
+    # Name, size and mtime of every CSV input; any change makes a new cache key
+    sig = []
+    for p in list_csv_files(in_dir):
+        info = p.stat()
+        sig.append((p.name, info.st_size, info.st_mtime_ns))
+    return tuple(sig)
+
+
+def output_signature(output_folder: str, written: list) -> Optional[tuple]:
+    # Name, size and mtime of every file a batch wrote; None if any is gone
+    sig = []
+    for _, out, _ in written:
+        try:
+            info = (Path(output_folder) / out).stat()
+        except OSError:
+            return None
+        sig.append((out, info.st_size, info.st_mtime_ns))
+    return tuple(sig)
+
+
+CSV_BATCH_CACHE_MAX = 32
+
+
+@st.cache_resource
+def _csv_batch_cache() -> dict:
+    # Shared by all sessions and kept across reruns. Unlike st.cache_data,
+    # entries can be replaced one at a time when they go stale
+    return {"lock": threading.Lock(), "entries": OrderedDict()}
+
+
+def run_csv_batch(
+    input_folder: str,
+    output_folder: str,
+    country: str,
+    vertex_order_col: Optional[str] = None,
+) -> dict:
+    in_dir = Path(input_folder)
+    if not in_dir.is_dir():
+        return batch_csv_to_geojson(input_folder, output_folder, country, vertex_order_col)
+
+    # input_folder is left out of the key; the signature stands in for its contents
+    key = (csv_batch_signature(in_dir), output_folder, country, vertex_order_col)
+    cache = _csv_batch_cache()
+    with cache["lock"]:
+        hit = cache["entries"].get(key)
+    # A cached summary is only valid while every file it reports is exactly as
+    # that run left it; another run (e.g. a different country) may have
+    # rewritten them since
+    if hit is not None and output_signature(output_folder, hit[0]["written"]) == hit[1]:
+        return copy.deepcopy(hit[0])
+
+    summary = batch_csv_to_geojson(input_folder, output_folder, country, vertex_order_col)
+    with cache["lock"]:
+        entries = cache["entries"]
+        if summary["errors"]:
+            # Failures may be transient (e.g. an output locked open in QGIS),
+            # so they are never cached and the next Run retries
+            entries.pop(key, None)
+        else:
+            entries[key] = (copy.deepcopy(summary), output_signature(output_folder, summary["written"]))
+            entries.move_to_end(key)
+            while len(entries) > CSV_BATCH_CACHE_MAX:
+                entries.popitem(last=False)
+    return summary
+
+
+def session_temp_dir() -> Path:
+    # One upload folder per browser session, reused by every quick run so
+    # unchanged uploads aren't copied again. The TemporaryDirectory lives in
+    # session_state, so its finalizer removes the folder once Streamlit drops
+    # the session (or at the latest when the server exits)
+    if "eudr_tmp" not in st.session_state:
+        tmp = tempfile.TemporaryDirectory(prefix="eudr_quick_", ignore_cleanup_errors=True)
+        st.session_state["eudr_tmp"] = tmp
+        st.session_state["eudr_tmp_files"] = {}
+    return Path(st.session_state["eudr_tmp"].name)
 
 
 # -----------------------------------------------------------------------------
-# Processor registry
+# Responsive helper (safe)
 # -----------------------------------------------------------------------------
 
-PROCESSORS: Dict[str, Set[str]] = {
-    "merge_geojson": {".geojson"},
-    "csv_to_geojson": {".csv"},
-    "extract_embedded": {".xlsx", ".zip"},
+# Fixed column ratios; the browser collapses them on narrow windows, so the
+# layout never needs the client width on the server side
+QUICK_LAYOUT = (1.4, 1.2, 2.0)
+
+_RESPONSIVE_CSS = """
+<style>
+@media (max-width: 1000px) {
+  [data-testid="stHorizontalBlock"] { flex-wrap: wrap; }
+  [data-testid="stColumn"], [data-testid="column"] {
+    flex: 1 1 100% !important;
+    min-width: 100% !important;
+  }
 }
+</style>
+"""
 
 
 # -----------------------------------------------------------------------------
 # UI
 # -----------------------------------------------------------------------------
 
-inject_width_tracker()
-client_width = get_client_width()
+st.markdown(_RESPONSIVE_CSS, unsafe_allow_html=True)
 
 st.title("EUDR Data Tools")
 st.caption("Runs locally — no external sharing or uploads.")
 st.subheader("Universal Quick Process")
 
-out_root_default = Path(cfg_get("defaults", "output_folder", str(APP_DIR / "Output")))
+out_root_default = Path(cfg_get("defaults", "output_folder", DEFAULT_OUTPUT))
+country_default = cfg_get("defaults", "default_country", "NZ")
+country_default_geo = cfg_get("merge_geojson", "default_country", country_default)
+country_default_csv = cfg_get("csv_to_geojson", "default_country", country_default)
 
-left_col, mid_col, right_col = st.columns(
-    quick_layout(client_width)
-)
+left_col, mid_col, right_col = st.columns(QUICK_LAYOUT)
 
 
 # -----------------------------------------------------------------------------
@@ -199,42 +302,35 @@ with right_col:
     else:
         st.caption("No files uploaded — upload to enable quick run")
 
-    opt_cols = st.columns(2)
-
-    producer_country_geo = None
-    producer_country_csv = None
-    out_name_quick = "EUDR-Tool-Output"
-
-    if ".geojson" in detected_exts:
-        with opt_cols[0]:
-            producer_country_geo = st.text_input(
-                "ProducerCountry (Merge GeoJSON)",
-                cfg_get(
-                    "merge_geojson",
-                    "default_country",
-                    cfg_get("defaults", "default_country", "NZ"),
-                ),
-            )
-        with opt_cols[0]:
-            out_name_quick = st.text_input(
-                "Output file name (Merge GeoJSON)",
-                out_name_quick,
-            )
-
-    if ".csv" in detected_exts:
-        with opt_cols[0]:
-            producer_country_csv = st.text_input(
-                "ProducerCountry (CSV → GeoJSON)",
-                cfg_get(
-                    "csv_to_geojson",
-                    "default_country",
-                    cfg_get("defaults", "default_country", "NZ"),
-                ),
-            )
-
     to_run: List[str] = []
 
     with st.form(key="quick_run_form", clear_on_submit=False):
+        # Options live inside the form so editing them doesn't rerun the script
+        opt_cols = st.columns(2)
+
+        producer_country_geo = None
+        producer_country_csv = None
+        out_name_quick = "EUDR-Tool-Output"
+
+        if ".geojson" in detected_exts:
+            with opt_cols[0]:
+                producer_country_geo = st.text_input(
+                    "ProducerCountry (Merge GeoJSON)",
+                    country_default_geo,
+                )
+            with opt_cols[0]:
+                out_name_quick = st.text_input(
+                    "Output file name (Merge GeoJSON)",
+                    out_name_quick,
+                )
+
+        if ".csv" in detected_exts:
+            with opt_cols[0]:
+                producer_country_csv = st.text_input(
+                    "ProducerCountry (CSV → GeoJSON)",
+                    country_default_csv,
+                )
+
         run_button = st.form_submit_button(
             "Run selected processors",
             type="primary",
@@ -244,10 +340,7 @@ with right_col:
             if not quick_upload:
                 st.error("No files uploaded.")
             else:
-                to_run = [
-                    name for name, exts in PROCESSORS.items()
-                    if detected_exts & exts
-                ]
+                to_run = list(pick_processors(frozenset(detected_exts)))
 
                 if not to_run:
                     st.info("No supported file types found.")
@@ -255,36 +348,63 @@ with right_col:
                     st.info("Running: " + ", ".join(to_run))
 
                     try:
-                        with temp_dir("eudr_quick_") as tmp_folder:
-                            save_uploaded_files(quick_upload, tmp_folder)
-
-                            if "merge_geojson" in to_run:
-                                out_file = Path(quick_output_folder) / out_name_quick
-                                final_path, summary = merge_geojson(
-                                    input_folder=str(tmp_folder),
-                                    output_file=str(out_file),
-                                    producer_country=producer_country_geo
-                                    or cfg_get("defaults", "default_country", "NZ"),
-                                )
-                                st.success(f"merge_geojson → {final_path}")
-                                c1, c2 = st.columns(2)
-                                c1.metric("Files scanned", summary["files_scanned"])
-                                c2.metric("Unique features", summary["unique_features"])
-
-                                if summary.get("errors"):
-                                    with st.expander("Merge errors"):
-                                        for p, msg in summary["errors"]:
-                                            st.write(f"- {p}: {msg}")
-
-                            if "csv_to_geojson" in to_run:
+                        tmp_folder = session_temp_dir()
+                        save_uploaded_files(
+                            quick_upload,
+                            tmp_folder,
+                            st.session_state["eudr_tmp_files"],
+                        )
+
+                        tasks = {
+                            "merge_geojson": lambda: merge_geojson(
+                                input_folder=str(tmp_folder / "merge_geojson"),
+                                output_file=str(Path(quick_output_folder) / out_name_quick),
+                                producer_country=producer_country_geo
+                                or country_default,
+                                dedup_by=cfg_get("merge_geojson", "dedup_by", "feature"),
+                            ),
+                            "csv_to_geojson": lambda: run_csv_batch(
+                                str(tmp_folder / "csv_to_geojson"),
+                                quick_output_folder,
+                                producer_country_csv
+                                or country_default,
+                                None,
+                            ),
+                            "extract_embedded": lambda: extract_embedded(
+                                str(tmp_folder / "extract_embedded"),
+                                quick_output_folder,
+                                verify=bool(cfg_get("extract_embedded", "verify_json", False)),
+                            ),
+                        }
+
+                        # Processors read disjoint file types and write disjoint
+                        # outputs, so they run side by side; all st.* rendering
+                        # stays on the script thread, in registry order.
+                        with ThreadPoolExecutor(max_workers=len(to_run)) as ex:
+                            futures = {name: ex.submit(tasks[name]) for name in to_run}
+
+                            if "merge_geojson" in futures:
                                 try:
-                                    summary = batch_csv_to_geojson(
-                                        str(tmp_folder),
-                                        quick_output_folder,
-                                        producer_country_csv
-                                        or cfg_get("defaults", "default_country", "NZ"),
-                                        None,
-                                    )
+                                    final_path, summary = futures["merge_geojson"].result()
+                                except Exception as e:
+                                    st.error(f"merge_geojson failed: {e}")
+                                else:
+                                    st.success(f"merge_geojson → {final_path}")
+                                    c1, c2 = st.columns(2)
+                                    c1.metric("Files scanned", summary["files_scanned"])
+                                    c2.metric("Unique features", summary["unique_features"])
+
+                                    if summary.get("errors"):
+                                        with st.expander("Merge errors"):
+                                            for p, msg in summary["errors"]:
+                                                st.write(f"- {p}: {msg}")
+
+                            if "csv_to_geojson" in futures:
+                                try:
+                                    summary = futures["csv_to_geojson"].result()
+                                except Exception as e:
+                                    st.error(f"csv_to_geojson failed: {e}")
+                                else:
                                     st.success(
                                         f"csv_to_geojson → "
                                         f"{summary['outputs']} of {summary['inputs']} files"
@@ -298,24 +418,22 @@ with right_col:
                                             for name, msg in summary["errors"]:
                                                 st.write(f"- {name}: {msg}")
 
+                            if "extract_embedded" in futures:
+                                try:
+                                    s = futures["extract_embedded"].result()
                                 except Exception as e:
-                                    st.error(f"csv_to_geojson failed: {e}")
-
-                            if "extract_embedded" in to_run:
-                                s = extract_embedded(
-                                    str(tmp_folder),
-                                    quick_output_folder,
-                                )
-                                st.success("extract_embedded completed")
-                                c1, c2, c3 = st.columns(3)
-                                c1.metric(".xlsx", s["xlsx"])
-                                c2.metric(".zip", s["zip"])
-                                c3.metric("nested zips", s["nested_zips"])
-
-                                if s.get("outputs"):
-                                    with st.expander("Extraction outputs"):
-                                        for src, outp in s["outputs"]:
-                                            st.write(f"- {src} → {outp}")
+                                    st.error(f"extract_embedded failed: {e}")
+                                else:
+                                    st.success("extract_embedded completed")
+                                    c1, c2, c3 = st.columns(3)
+                                    c1.metric(".xlsx", s["xlsx"])
+                                    c2.metric(".zip", s["zip"])
+                                    c3.metric("nested zips", s["nested_zips"])
+
+                                    if s.get("outputs"):
+                                        with st.expander("Extraction outputs"):
+                                            for src, outp in s["outputs"]:
+                                                st.write(f"- {src} → {outp}")
 
                     except Exception as e:
                         st.error(f"Processing error: {e}")
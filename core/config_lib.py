@@ -0,0 +1,53 @@
+
+# core/config_lib.py
+from __future__ import annotations
+import json
+from functools import lru_cache
+from pathlib import Path
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader as YamlLoader
+
+@lru_cache(maxsize=4)
+def _parse_yaml(text: str) -> dict:
+    # Keyed on the file contents; callers must not mutate the returned dict
+    return yaml.load(text, Loader=YamlLoader) or {}
+
+def read_config(path: Path) -> dict:
+    # A JSON copy next to the YAML is much cheaper to parse. It records the
+    # YAML's mtime and size and is only trusted on an exact match: a copied-in
+    # config (e.g. from config_Default.yaml) can carry an older mtime
+    cache = path.with_suffix(path.suffix + ".cache.json")
+    info = path.stat()
+    stamp = [info.st_mtime_ns, info.st_size]
+    try:
+        cached = json.loads(cache.read_bytes())
+        if cached.get("stamp") == stamp:
+            return cached["data"]
+    except (OSError, ValueError, AttributeError, KeyError):
+        pass
+    data = _parse_yaml(path.read_text(encoding="utf-8"))
+    try:
+        text = json.dumps({"stamp": stamp, "data": data})
+        # JSON turns non-string keys into strings, so only cache data that
+        # comes back unchanged; otherwise cached loads would differ
+        if json.loads(text)["data"] == data:
+            cache.write_text(text, encoding="utf-8")
+    except (OSError, TypeError, ValueError):
+        pass  # read-only folder or values JSON can't hold; just skip the cache
+    return data
+
+def load_config(path: Path, defaults: dict) -> dict:
+    if not path.exists():
+        return defaults
+    try:
+        data = dict(read_config(path))
+        for k, v in defaults.items():
+            data.setdefault(k, v)
+        return data
+    except Exception:
+        return defaults
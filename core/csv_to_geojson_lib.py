@@ -1,10 +1,23 @@
 from __future__ import annotations
 import json
+import multiprocessing
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import suppress
+from itertools import islice, repeat
 from pathlib import Path
-from typing import Dict, Any, List, Optional, Tuple
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
-from shapely.geometry import Polygon, Point
+
+try:
+    import orjson
+except ImportError:  # optional; fall back to the stdlib encoder
+    orjson = None
+
+from core.output_lib import dumps_compact
 
 COLUMN_ALIASES = {
     "polygon_id": ["Polygon #", "Polygon", "Plot ID", "ShapeID"],
@@ -19,6 +32,17 @@ COLUMN_ALIASES = {
     "under_4ha": ["Under 4Ha?", "Under4Ha"],
 }
 
+# Canonical fields copied into each feature's properties
+PROPERTY_FIELDS = ("producer", "forest", "date_start", "date_end", "percent_supply", "under_4ha")
+
+# Every column the converter can use; anything else in the CSV is skipped at parse time
+ALIAS_COLUMNS = frozenset(c for options in COLUMN_ALIASES.values() for c in options)
+
+# Features encoded per call when streaming
+STREAM_CHUNK_FEATURES = 1000
+# Batches smaller than this use threads rather than worker processes
+PROCESS_POOL_MIN_FILES = 4
+
 def resolve_columns(
     df: pd.DataFrame,
     aliases: Dict[str, List[str]],
@@ -33,59 +57,61 @@ def resolve_columns(
         resolved[canonical] = match
     return resolved
 
-def convert_csv_to_geojson(
-    input_path: Path,
-    output_path: Path,
+def to_float_array(s: pd.Series) -> np.ndarray:
+    """Coerce a column to float64; unparseable or missing values become NaN."""
+    return pd.to_numeric(s, errors="coerce").to_numpy(np.float64, na_value=np.nan)
+
+def iter_features(
+    df: pd.DataFrame,
+    cols: Dict[str, Optional[str]],
     country: str,
     vertex_order_col: Optional[str] = None,
-) -> Tuple[int, Optional[str]]:
-    """Return (#features_written, error_message_if_any)."""
-
-    try:
-        df = pd.read_csv(input_path)
-    except Exception as e:
-        return 0, f"Failed to read {input_path.name}: {e}"
+) -> Iterator[Dict[str, Any]]:
+    """Yield one GeoJSON Feature per polygon id, in order of first appearance."""
 
-    cols = resolve_columns(df, COLUMN_ALIASES)
-
-    # Required fields
-    required = ["polygon_id", "longitude", "latitude"]
-    missing = [r for r in required if cols[r] is None]
-    if missing:
-        return 0, f"Missing required column(s): {', '.join(missing)}"
+    if vertex_order_col and vertex_order_col in df.columns:
+        # One stable sort of the frame leaves every group's rows in vertex order
+        df = df.sort_values(vertex_order_col, kind="stable", ignore_index=True)
 
-    features: List[Dict[str, Any]] = []
+    # Coordinates are coerced once for the whole frame, not per row
+    xy = np.column_stack((
+        to_float_array(df[cols["longitude"]]),
+        to_float_array(df[cols["latitude"]]),
+    ))
+    valid = np.isfinite(xy).all(axis=1)
 
-    for poly_id, group in df.groupby(cols["polygon_id"]):
-        if vertex_order_col and vertex_order_col in group.columns:
-            group = group.sort_values(by=vertex_order_col)
+    groups = df.groupby(cols["polygon_id"], sort=False, observed=True).indices
 
-        coords: List[Tuple[float, float]] = []
-        for x, y in zip(group[cols["longitude"]], group[cols["latitude"]]):
-            if pd.notnull(x) and pd.notnull(y):
-                try:
-                    coords.append((float(x), float(y)))
-                except ValueError:
-                    continue
+    # Property values come from each polygon's first row; pull them all as
+    # plain dicts in one pass rather than building a Series per polygon
+    prop_cols = [c for k, c in cols.items() if c and k in PROPERTY_FIELDS]
+    if prop_cols:
+        firsts = df[prop_cols].iloc[[idx[0] for idx in groups.values()]].to_dict("records")
+    else:
+        firsts = [{}] * len(groups)
 
-        if not coords:
+    for (poly_id, idx), first in zip(groups.items(), firsts):
+        sel = idx[valid[idx]]
+        if not len(sel):
             continue
 
+        coords = xy[sel].tolist()
+        if isinstance(poly_id, np.generic):
+            poly_id = poly_id.item()
+
         if len(coords) >= 3:
-            poly = Polygon(coords)
+            # Close the ring the way shapely's Polygon would
+            ring = coords if coords[0] == coords[-1] else coords + [coords[0]]
             geom = {
                 "type": "Polygon",
-                "coordinates": [list(map(list, poly.exterior.coords))],
+                "coordinates": [ring],
             }
         else:
-            pt = Point(coords[0])
             geom = {
                 "type": "Point",
-                "coordinates": [pt.x, pt.y],
+                "coordinates": coords[0],
             }
 
-        first = group.iloc[0]
-
         props = {
             "Polygon #": poly_id,
             "ProducerName": first.get(cols["producer"]) if cols["producer"] else None,
@@ -97,28 +123,104 @@ def convert_csv_to_geojson(
             "ProducerCountry": country,
         }
 
-        features.append(
-            {
-                "type": "Feature",
-                "geometry": geom,
-                "properties": props,
-            }
-        )
+        yield {
+            "type": "Feature",
+            "geometry": geom,
+            "properties": props,
+        }
 
-    fc = {
-        "type": "FeatureCollection",
-        "features": features,
-    }
+def stream_feature_collection(
+    features: Iterable[Dict[str, Any]],
+    output_path: Path,
+    chunk_size: int = STREAM_CHUNK_FEATURES,
+) -> int:
+    """Write features as a compact FeatureCollection, chunk by chunk; return the count."""
+    n = 0
+    it = iter(features)
+    with output_path.open("wb") as f:
+        f.write(b'{"type":"FeatureCollection","features":[')
+        while chunk := list(islice(it, chunk_size)):
+            # One encoder call per chunk: encode as an array, drop the brackets
+            if n:
+                f.write(b",")
+            f.write(dumps_compact(chunk)[1:-1])
+            n += len(chunk)
+        f.write(b"]}")
+    return n
 
+def convert_csv_to_geojson(
+    input_path: Path,
+    output_path: Path,
+    country: str,
+    vertex_order_col: Optional[str] = None,
+    streaming: bool = True,
+) -> Tuple[int, Optional[str]]:
+    """Return (#features_written, error_message_if_any).
+
+    By default features are encoded and written as they are built, so the
+    whole FeatureCollection is never held in memory and the output is compact.
+    streaming=False builds the full document and writes it indented.
+    """
+
+    wanted = (ALIAS_COLUMNS | {vertex_order_col}) if vertex_order_col else ALIAS_COLUMNS
+    try:
+        # memory_map lets the C parser read straight from the page cache
+        # instead of copying the file through a Python file object
+        df = pd.read_csv(input_path, engine="c", memory_map=True, usecols=lambda c: c in wanted)
+    except Exception as e:
+        return 0, f"Failed to read {input_path.name}: {e}"
+
+    cols = resolve_columns(df, COLUMN_ALIASES)
+
+    # Required fields
+    required = ["polygon_id", "longitude", "latitude"]
+    missing = [r for r in required if cols[r] is None]
+    if missing:
+        return 0, f"Missing required column(s): {', '.join(missing)}"
+
+    features = iter_features(df, cols, country, vertex_order_col)
+
+    # Write under a temporary name in the output folder and move it into
+    # place only once complete, so a failure never leaves a truncated
+    # <stem>.geojson behind
+    tmp_path = output_path.with_name(f".{output_path.name}.{uuid.uuid4().hex[:8]}.part")
     try:
         output_path.parent.mkdir(parents=True, exist_ok=True)
-        output_path.write_text(
-            json.dumps(fc, indent=2, ensure_ascii=False),
-            encoding="utf-8",
-        )
-        return len(features), None
+        if streaming:
+            n = stream_feature_collection(features, tmp_path)
+        else:
+            fc = {
+                "type": "FeatureCollection",
+                "features": list(features),
+            }
+            if orjson is not None:
+                tmp_path.write_bytes(
+                    orjson.dumps(fc, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY)
+                )
+            else:
+                tmp_path.write_text(
+                    json.dumps(fc, indent=2, ensure_ascii=False),
+                    encoding="utf-8",
+                )
+            n = len(fc["features"])
+        os.replace(tmp_path, output_path)
+        return n, None
+    except OSError as e:
+        err = f"Failed to write {output_path.name}: {e}"
     except Exception as e:
-        return 0, f"Failed to write {output_path.name}: {e}"
+        err = f"Failed to convert {input_path.name}: {e}"
+    with suppress(OSError):
+        tmp_path.unlink(missing_ok=True)
+    return 0, err
+
+def list_csv_files(in_dir: Path) -> List[Path]:
+    # One scandir pass; DirEntry carries the file type, so no extra stat per entry
+    with os.scandir(in_dir) as it:
+        names = sorted(
+            e.name for e in it
+            if e.name.lower().endswith(".csv") and e.is_file()
+        )
+    return [in_dir / n for n in names]
 
 def batch_csv_to_geojson(
     input_folder: str,
@@ -132,20 +234,36 @@ def batch_csv_to_geojson(
     if not in_dir.is_dir():
         raise ValueError(f"Input folder does not exist: {input_folder}")
 
-    csv_files = sorted(p for p in in_dir.iterdir() if p.suffix.lower() == ".csv")
+    csv_files = list_csv_files(in_dir)
     if not csv_files:
         raise FileNotFoundError("No CSV files found in the input folder.")
 
     outputs, errors = [], []
 
-    for csv_path in csv_files:
-        out_path = out_dir / f"{csv_path.stem}.geojson"
-        n, err = convert_csv_to_geojson(
-            csv_path,
-            out_path,
-            country,
-            vertex_order_col,
-        )
+    out_paths = [out_dir / f"{p.stem}.geojson" for p in csv_files]
+    args = (
+        csv_files,
+        out_paths,
+        repeat(country),
+        repeat(vertex_order_col),
+    )
+
+    # Files are independent, so convert them on separate cores. Spawning worker
+    # processes (and re-importing pandas in each) only pays off for larger
+    # batches; a couple of files share threads instead. Workers are always
+    # spawned, as on Windows: forking the multi-threaded Streamlit server can
+    # deadlock the children.
+    workers = min(len(csv_files), os.cpu_count() or 1)
+    if len(csv_files) >= PROCESS_POOL_MIN_FILES and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as ex:
+            results = list(ex.map(convert_csv_to_geojson, *args))
+    elif len(csv_files) > 1:
+        with ThreadPoolExecutor(max_workers=len(csv_files)) as ex:
+            results = list(ex.map(convert_csv_to_geojson, *args))
+    else:
+        results = list(map(convert_csv_to_geojson, *args))
+
+    for csv_path, out_path, (n, err) in zip(csv_files, out_paths, results):
         if err:
             errors.append((csv_path.name, err))
         else:
@@ -1,9 +1,19 @@
 
 # core/extract_embedded_lib.py
 from __future__ import annotations
-import os, stat, shutil, zipfile
-from pathlib import Path
-from typing import Dict, Any, List, Tuple, Optional
+import io, os, json, mmap, stat, shutil, tempfile, zipfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+from pathlib import Path, PurePosixPath
+from typing import Dict, Any, BinaryIO, Iterable, Iterator, List, Tuple, Optional, Union
+
+try:
+    import orjson
+except ImportError:  # optional; fall back to the stdlib parser
+    orjson = None
+
+from core.output_lib import claim_unique
 
 def remove_readonly(func, path, exc_info):
     try:
@@ -15,7 +25,7 @@ def remove_readonly(func, path, exc_info):
     except Exception:
         pass
 
-def safe_extract_zip(zip_path: Path, dest: Path) -> bool:
+def safe_extract_zip(zip_path: Union[Path, BinaryIO], dest: Path) -> bool:
     try:
         with zipfile.ZipFile(zip_path, 'r') as z:
             z.extractall(dest)
@@ -25,90 +35,193 @@ def safe_extract_zip(zip_path: Path, dest: Path) -> bool:
     except Exception:
         return False
 
-def clean_json_from_bin(bin_path: Path) -> Optional[str]:
+JSON_START = b'{"type":'
+JSON_END = b'"type":"Polygon"}}]}'
+
+def clean_json_from_buffer(buf) -> Optional[bytes]:
+    """Cut the embedded GeoJSON out of a bytes-like buffer (bytes or mmap)."""
+    # The markers are ASCII, so they can be found without decoding the buffer,
+    # and the slice is returned exactly as stored
+    start = buf.find(JSON_START)
+    end_idx = buf.rfind(JSON_END)
+    if start >= 0 and end_idx >= 0:
+        hit = buf[start:end_idx + len(JSON_END)]
+    else:
+        first = buf.find(b'{'); last = buf.rfind(b'}')
+        if not (first >= 0 and last > first and buf.find(b'"type"', first, last) >= 0):
+            return None
+        hit = buf[first:last + 1]
+    return bytes(hit)
+
+def clean_json_from_bin(bin_path: Path) -> Optional[bytes]:
     try:
-        text = bin_path.read_bytes().decode('utf-8', errors='ignore')
-    except Exception:
+        with open(bin_path, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return clean_json_from_buffer(mm)
+    except Exception:  # unreadable, or empty (an empty file can't be mapped)
         return None
-    start = text.find('{"type":')
-    end_marker = '"type":"Polygon"}}]}'
-    end_idx = text.rfind(end_marker)
-    if start >= 0 and end_idx >= 0:
-        return text[start:end_idx + len(end_marker)]
-    first = text.find('{'); last = text.rfind('}')
-    if first >= 0 and last > first and '"type"' in text[first:last]:
-        return text[first:last + 1]
-    return None
+
+def is_valid_json(data: bytes) -> bool:
+    try:
+        if orjson is not None:
+            orjson.loads(data)
+        else:
+            json.loads(data)
+        return True
+    except ValueError:  # orjson.JSONDecodeError and UnicodeDecodeError included
+        return False
 
 def unique_dir(base: Path) -> Path:
-    if not base.exists():
-        return base
-    idx = 1
-    while True:
-        candidate = base.with_name(f"{base.name}_{idx}")
-        if not candidate.exists():
-            return candidate
-        idx += 1
-
-def extract_embedded(src_folder: str, out_folder: str):
-    SRC = Path(src_folder); OUT = Path(out_folder); TEMP = OUT / "temp"
-    OUT.mkdir(parents=True, exist_ok=True); TEMP.mkdir(parents=True, exist_ok=True)
+    """Create and return base, or the first free base_1, base_2, ..."""
+    base.parent.mkdir(parents=True, exist_ok=True)
+    return claim_unique(base.parent, base.name, "", Path.mkdir)[0]
 
-    n_xlsx = n_zip = n_nested_zips = n_bin_processed = n_json_cleaned = n_zip_bins_extracted = errors = 0
-    files_found = list(SRC.glob("*.xlsx")) + list(SRC.glob("*.zip"))
-    if not files_found:
-        return {
-            "xlsx": 0, "zip": 0, "nested_zips": 0, "bin_processed": 0,
-            "zip_bins_extracted": 0, "json_cleaned": 0, "errors": 0,
-            "outputs_root": str(OUT.resolve()), "outputs": []
-        }
+def list_inputs(src: Path, exts: Tuple[str, ...] = (".xlsx", ".zip")) -> List[Path]:
+    # One directory pass instead of a glob per extension; DirEntry caches the type
+    if not src.is_dir():
+        return []
+    with os.scandir(src) as it:
+        names = sorted(
+            e.name for e in it
+            if e.name.lower().endswith(exts) and e.is_file(follow_symlinks=False)
+        )
+    return [src / n for n in names]
 
-    outputs: List[Tuple[str, str]] = []
+def is_embedded_bin(name: str) -> bool:
+    return name.lower().endswith(".bin") and not name.startswith("printerSettings")
 
-    for file in files_found:
-        temp_dir = TEMP / file.stem; temp_dir.mkdir(parents=True, exist_ok=True)
-        final_dir = unique_dir(OUT / file.stem); final_dir.mkdir(parents=True, exist_ok=True)
+# Nested archives up to this size are opened in memory, larger ones spill to disk
+NESTED_ZIP_SPOOL_BYTES = 16 << 20
 
-        ok = safe_extract_zip(file, temp_dir)
-        if ok:
-            if file.suffix.lower() == ".xlsx": n_xlsx += 1
-            else: n_zip += 1
-        else:
-            errors += 1
+def iter_zip_bins(z: zipfile.ZipFile, counts: Counter, nested: bool = True) -> Iterator[Tuple[str, bytes]]:
+    """Yield (stem, data) for the embedded .bin members of an open archive, one at a time.
+
+    Nested .zip members are searched one level deep. A member that can't be
+    read counts as an error and is skipped.
+    """
+    for info in z.infolist():
+        if info.is_dir():
             continue
+        name = PurePosixPath(info.filename).name
+        if is_embedded_bin(name):
+            try:
+                data = z.read(info)
+            except Exception:
+                counts["errors"] += 1
+                continue
+            yield PurePosixPath(name).stem, data
+        elif nested and name.lower().endswith(".zip"):
+            with tempfile.SpooledTemporaryFile(max_size=NESTED_ZIP_SPOOL_BYTES) as spool:
+                try:
+                    with z.open(info) as src:
+                        shutil.copyfileobj(src, spool)
+                    inner = zipfile.ZipFile(spool)
+                except Exception:
+                    continue
+                counts["nested_zips"] += 1
+                with inner:
+                    yield from iter_zip_bins(inner, counts, nested=False)
+
+def _process_bins(
+    bins: Iterable[Tuple[str, Any]],
+    file: Path,
+    final_dir: Path,
+    verify: bool,
+    counts: Counter,
+    outputs: List[Tuple[str, str]],
+) -> None:
+    # Each bin is either an archive of its own or has GeoJSON embedded in it;
+    # in-memory bins are bytes, unpacked ones are paths
+    for stem, src in bins:
+        counts["bin_processed"] += 1
+        in_memory = isinstance(src, bytes)
+        if safe_extract_zip(io.BytesIO(src) if in_memory else src, final_dir):
+            counts["zip_bins_extracted"] += 1
+            continue
+        cleaned = clean_json_from_buffer(src) if in_memory else clean_json_from_bin(src)
+        if cleaned and (not verify or is_valid_json(cleaned)):
+            out_file, fh = claim_unique(final_dir, stem, ".geojson", lambda p: p.open('xb'))
+            with fh:
+                fh.write(cleaned)
+            counts["json_cleaned"] += 1
+            outputs.append((file.name, str(out_file)))
+        else:
+            counts["errors"] += 1
+
+def _process_one(file: Path, final_dir: Path, temp_dir: Path, verify: bool = False) -> Tuple[Counter, List[Tuple[str, str]]]:
+    """Unpack one .xlsx/.zip into final_dir; return (counters, outputs).
+
+    With verify=True a cleaned blob is only written if it parses as JSON.
+    """
+    counts: Counter = Counter()
+    outputs: List[Tuple[str, str]] = []
+
+    # Only a workbook's embedded .bin parts matter, and their layout is known,
+    # so read those members straight from the archive as they are needed.
+    # Other .zip inputs are unpacked to disk as before, since anything in
+    # them may be relevant.
+    if file.suffix.lower() == ".xlsx":
+        try:
+            z = zipfile.ZipFile(file)
+        except Exception:
+            counts["errors"] += 1
+            return counts, outputs
+        counts["xlsx"] += 1
+        with z:
+            _process_bins(iter_zip_bins(z, counts), file, final_dir, verify, counts, outputs)
+    else:
+        temp_dir.mkdir(parents=True, exist_ok=True)
+        if not safe_extract_zip(file, temp_dir):
+            counts["errors"] += 1
+            return counts, outputs
+        counts["zip"] += 1
 
         for zip_path in temp_dir.rglob("*.zip"):
             inner_dest = zip_path.with_name(zip_path.stem + "_inner")
             inner_dest.mkdir(exist_ok=True)
             if safe_extract_zip(zip_path, inner_dest):
-                n_nested_zips += 1
+                counts["nested_zips"] += 1
 
-        bin_files = [f for f in temp_dir.rglob("*.bin") if not f.name.startswith("printerSettings")]
-        for bin_file in bin_files:
-            n_bin_processed += 1
-            if safe_extract_zip(bin_file, final_dir):
-                n_zip_bins_extracted += 1
-                continue
-            cleaned = clean_json_from_bin(bin_file)
-            if cleaned:
-                out_file = final_dir / f"{bin_file.stem}.geojson"
-                i = 1
-                while out_file.exists():
-                    out_file = final_dir / f"{bin_file.stem}_{i}.geojson"
-                    i += 1
-                out_file.write_text(cleaned, encoding='utf-8')
-                n_json_cleaned += 1
-                outputs.append((file.name, str(out_file)))
-            else:
-                errors += 1
+        bins = [(f.stem, f) for f in temp_dir.rglob("*.bin") if not f.name.startswith("printerSettings")]
+        _process_bins(bins, file, final_dir, verify, counts, outputs)
 
+    if temp_dir.exists():
         shutil.rmtree(temp_dir, onerror=remove_readonly)
+    return counts, outputs
+
+def extract_embedded(src_folder: str, out_folder: str, verify: bool = False):
+    SRC = Path(src_folder); OUT = Path(out_folder); TEMP = OUT / "temp"
+    OUT.mkdir(parents=True, exist_ok=True); TEMP.mkdir(parents=True, exist_ok=True)
+
+    files_found = list_inputs(SRC)
+    if not files_found:
+        return {
+            "xlsx": 0, "zip": 0, "nested_zips": 0, "bin_processed": 0,
+            "zip_bins_extracted": 0, "json_cleaned": 0, "errors": 0,
+            "outputs_root": str(OUT.resolve()), "outputs": []
+        }
+
+    # Output folders are claimed up front, in file order, so workers never race
+    # on unique_dir; each input also gets its own scratch folder under TEMP
+    final_dirs = []
+    for file in files_found:
+        final_dirs.append(unique_dir(OUT / file.stem))
+    temp_dirs = [TEMP / file.name for file in files_found]
+
+    # Inputs are independent and the work is mostly file I/O and zlib, which
+    # releases the GIL, so threads are enough
+    totals: Counter = Counter()
+    outputs: List[Tuple[str, str]] = []
+    workers = min(len(files_found), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for counts, outs in ex.map(_process_one, files_found, final_dirs, temp_dirs, repeat(verify)):
+            totals.update(counts)
+            outputs.extend(outs)
 
     shutil.rmtree(TEMP, onerror=remove_readonly)
 
     return {
-        "xlsx": n_xlsx, "zip": n_zip, "nested_zips": n_nested_zips,
-        "bin_processed": n_bin_processed, "zip_bins_extracted": n_zip_bins_extracted,
-        "json_cleaned": n_json_cleaned, "errors": errors,
+        "xlsx": totals["xlsx"], "zip": totals["zip"], "nested_zips": totals["nested_zips"],
+        "bin_processed": totals["bin_processed"], "zip_bins_extracted": totals["zip_bins_extracted"],
+        "json_cleaned": totals["json_cleaned"], "errors": totals["errors"],
         "outputs_root": str(OUT.resolve()), "outputs": outputs
     }
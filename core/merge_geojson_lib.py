@@ -1,17 +1,91 @@
 
 # core/merge_geojson_lib.py
 from __future__ import annotations
-import os, json, glob, hashlib
+import os, json, hashlib
 from pathlib import Path
-from typing import List, Tuple, Optional, Dict, Any
+from typing import List, Tuple, Optional, Dict, Any, BinaryIO, Iterable, Iterator
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 
-def feature_hash(feature: Dict[str, Any]) -> str:
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # optional; fall back to the stdlib encoder
+    orjson = None
+
+try:
+    import xxhash
+except ImportError:  # optional; fall back to hashlib
+    xxhash = None
+
+from core.output_lib import claim_unique, dumps_compact
+
+def canonical_bytes(obj: Any) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+        except TypeError:  # e.g. integers beyond 64 bits
+            pass
+    return json.dumps(obj, sort_keys=True).encode("utf-8")
+
+DEDUP_MODES = ("feature", "geometry")
+
+def feature_hash(feature: Dict[str, Any], dedup_by: str = "feature"):
+    # Only used for in-memory dedup, so a fast non-cryptographic 128-bit digest
+    # is enough; the result is an int (xxhash) or 16 raw bytes (blake2b)
     geom = feature.get("geometry", {})
-    props = {k: v for k, v in feature.get("properties", {}).items()
-             if k not in ["ProductionPlace", "ProducerCountry"]}
-    data = json.dumps({"geometry": geom, "properties": props}, sort_keys=True)
-    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+    if dedup_by == "geometry":
+        data = canonical_bytes(geom)
+    else:
+        props = {k: v for k, v in feature.get("properties", {}).items()
+                 if k not in ["ProductionPlace", "ProducerCountry"]}
+        data = canonical_bytes({"geometry": geom, "properties": props})
+    if xxhash is not None:
+        return xxhash.xxh3_128_intdigest(data)
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+# orjson returns integers outside the 64-bit range as floats instead of
+# failing, and every such float has a magnitude of at least 2**63
+INT64_LIMIT = float(2 ** 63)
+
+def has_lossy_float(obj: Any) -> bool:
+    """True if obj holds a float that may be an integer orjson couldn't keep exact.
+
+    Geometry coordinates are skipped: they are read as numbers anyway, and
+    they make up the bulk of a file.
+    """
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if isinstance(o, dict):
+            stack.extend(v for k, v in o.items() if k != "coordinates")
+        elif isinstance(o, list):
+            stack.extend(o)
+        elif isinstance(o, float) and abs(o) >= INT64_LIMIT:
+            return True
+    return False
+
+def load_json(path: str) -> Any:
+    data = Path(path).read_bytes()
+    if orjson is not None:
+        try:
+            obj = orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass  # e.g. NaN literals; let the stdlib decide
+        else:
+            # Rare: a huge id or value in the properties; the stdlib keeps
+            # such integers exact
+            if not has_lossy_float(obj):
+                return obj
+    return json.loads(data.decode("utf-8"))
+
+def _load(path: str) -> Tuple[Any, Optional[Exception]]:
+    try:
+        return load_json(path), None
+    except Exception as e:
+        return None, e
 
 def to_features(obj: Dict[str, Any], source_name: Optional[str] = None, producer_country: str = "Unknown") -> List[Dict[str, Any]]:
     file_name = Path(source_name).stem if source_name else "Unknown"
@@ -35,19 +109,32 @@ def to_features(obj: Dict[str, Any], source_name: Optional[str] = None, producer
         features.append({"type":"Feature","geometry":obj,"properties":{"ProductionPlace":file_name,"ProducerCountry":producer_country}})
     return features
 
+def is_position(c: Any) -> bool:
+    return (isinstance(c, (list, tuple)) and len(c) >= 2
+            and isinstance(c[0], (int, float)) and isinstance(c[1], (int, float)))
+
+def iter_xy(coords: Any) -> Iterator[np.ndarray]:
+    """Yield (k, 2) float arrays holding the x/y of every position in a nested coordinate list."""
+    if not isinstance(coords, (list, tuple)) or not coords:
+        return
+    if is_position(coords):
+        yield np.array([coords[:2]], dtype=np.float64)
+        return
+    if is_position(coords[0]):
+        # A ring, line or multipoint: convert the whole list in one call and
+        # only walk it item by item if it is ragged or holds non-numbers
+        try:
+            arr = np.asarray(coords, dtype=np.float64)
+        except (TypeError, ValueError):
+            arr = None
+        if arr is not None and arr.ndim == 2 and np.isfinite(arr[:, :2]).all():
+            yield arr[:, :2]
+            return
+    for item in coords:
+        yield from iter_xy(item)
+
 def compute_bbox(features: List[Dict[str, Any]]) -> Optional[List[float]]:
-    def walk_coords(coords, acc):
-        if isinstance(coords, (list, tuple)):
-            if len(coords) >= 2 and all(isinstance(c, (int, float)) for c in coords[:2]):
-                x, y = coords[:2]
-                acc[0] = x if acc[0] is None else min(acc[0], x)
-                acc[1] = y if acc[1] is None else min(acc[1], y)
-                acc[2] = x if acc[2] is None else max(acc[2], x)
-                acc[3] = y if acc[3] is None else max(acc[3], y)
-            else:
-                for item in coords:
-                    walk_coords(item, acc)
-    acc = [None, None, None, None]
+    parts: List[np.ndarray] = []
     for f in features:
         geom = f.get("geometry")
         if not geom:
@@ -55,17 +142,60 @@ def compute_bbox(features: List[Dict[str, Any]]) -> Optional[List[float]]:
         coords = geom.get("coordinates")
         if coords is None and geom.get("type") == "GeometryCollection":
             for g in geom.get("geometries", []):
-                walk_coords(g.get("coordinates"), acc)
+                parts.extend(iter_xy(g.get("coordinates")))
         else:
-            walk_coords(coords, acc)
-    return acc if None not in acc else None
-
-def merge_geojson(input_folder: str, output_file: str, producer_country: str, add_bbox: bool=False) -> Tuple[str, Dict[str, Any]]:
+            parts.extend(iter_xy(coords))
+    if not parts:
+        return None
+    xy = np.concatenate(parts)
+    # fmin/fmax skip NaN rather than propagating it
+    lo, hi = np.fmin.reduce(xy, axis=0), np.fmax.reduce(xy, axis=0)
+    return [lo[0].item(), lo[1].item(), hi[0].item(), hi[1].item()]
+
+def write_feature_collection(features: Iterable[Dict[str, Any]], f: BinaryIO, bbox: Optional[List[float]] = None) -> None:
+    """Write a compact FeatureCollection to a binary file, one feature at a time."""
+    f.write(b'{"type":"FeatureCollection",')
+    if bbox:
+        f.write(b'"bbox":' + dumps_compact(bbox) + b",")
+    f.write(b'"features":[')
+    for i, feat in enumerate(features):
+        if i:
+            f.write(b",")
+        f.write(dumps_compact(feat))
+    f.write(b"]}")
+
+def iter_geojson_files(root: str) -> Iterator[str]:
+    """Yield every .geojson file under root, skipping hidden entries as glob does."""
+    stack = [root]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for e in it:
+                if e.name.startswith("."):
+                    continue
+                # DirEntry caches the file type, so this costs no extra stat
+                if e.is_dir():
+                    stack.append(e.path)
+                elif os.path.normcase(e.name).endswith(".geojson") and e.is_file():
+                    yield e.path
+
+def merge_geojson(input_folder: str, output_file: str, producer_country: str, add_bbox: bool=False, dedup_by: str="feature") -> Tuple[str, Dict[str, Any]]:
+    """Merge every .geojson under input_folder into one FeatureCollection.
+
+    dedup_by="feature" drops features whose geometry and source properties
+    both match an earlier one; dedup_by="geometry" keeps only the first
+    feature for each geometry, whatever its properties.
+    """
     in_dir = Path(input_folder)
     if not in_dir.is_dir():
         raise ValueError(f"Input is not a directory: {input_folder}")
+    if dedup_by not in DEDUP_MODES:
+        raise ValueError(f"dedup_by must be one of {', '.join(DEDUP_MODES)}: {dedup_by}")
 
-    paths = sorted(glob.glob(str(in_dir / "**" / "*.geojson"), recursive=True))
+    paths = sorted(iter_geojson_files(str(in_dir)))
     if not paths:
         raise FileNotFoundError(f"No .geojson files found in {input_folder}")
 
@@ -73,42 +203,50 @@ def merge_geojson(input_folder: str, output_file: str, producer_country: str, ad
     seen = set()
     errors: List[Tuple[str, str]] = []
 
-    for p in paths:
-        try:
-            data = json.loads(Path(p).read_text(encoding="utf-8"))
-            for feat in to_features(data, source_name=p, producer_country=producer_country):
-                h = feature_hash(feat)
-                if h not in seen:
-                    seen.add(h); all_features.append(feat)
-        except Exception as e:
-            errors.append((p, str(e)))
+    # Reading and parsing is per file and mostly I/O, so it runs on a thread
+    # pool; dedup stays on this thread and in path order, so the result is
+    # the same as a sequential merge
+    workers = min(32, (os.cpu_count() or 1) * 4, len(paths))
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for p, (data, err) in zip(paths, ex.map(_load, paths)):
+            if err is not None:
+                errors.append((p, str(err))); continue
+            try:
+                for feat in to_features(data, source_name=p, producer_country=producer_country):
+                    h = feature_hash(feat, dedup_by)
+                    if h not in seen:
+                        seen.add(h); all_features.append(feat)
+            except Exception as e:
+                errors.append((p, str(e)))
 
     if not all_features:
         raise RuntimeError("No features collected.")
 
-    merged: Dict[str, Any] = {"type": "FeatureCollection", "features": all_features}
-    if add_bbox:
-        bbox = compute_bbox(all_features)
-        if bbox:
-            merged["bbox"] = bbox
+    bbox = compute_bbox(all_features) if add_bbox else None
 
     out_file = Path(output_file if output_file.lower().endswith(".geojson") else f"{output_file}.geojson")
     out_file.parent.mkdir(parents=True, exist_ok=True)
 
-    final_out = out_file
-    i = 1
-    while final_out.exists():
-        final_out = out_file.with_name(f"{out_file.stem}_{i}{out_file.suffix}")
-        i += 1
-
-    Path(final_out).write_text(json.dumps(merged, ensure_ascii=False, indent=2), encoding="utf-8")
+    final_out, f = claim_unique(out_file.parent, out_file.stem, out_file.suffix, lambda p: p.open("xb"))
+    # Features are encoded and written one by one, so the whole document is
+    # never held as a second, serialized copy in memory. The name is ours
+    # (claimed exclusively), so a failed write removes it rather than leaving
+    # a truncated file behind
+    try:
+        with f:
+            write_feature_collection(all_features, f, bbox)
+    except BaseException:
+        with suppress(OSError):
+            final_out.unlink()
+        raise
 
     summary = {
         "files_scanned": len(paths),
         "unique_features": len(all_features),
         "errors": errors,
         "producer_country": producer_country,
-        "included_bbox": "bbox" in merged,
+        "dedup_by": dedup_by,
+        "included_bbox": bool(bbox),
         "timestamp": datetime.now().isoformat(timespec="seconds"),
     }
     return str(final_out), summary
@@ -0,0 +1,43 @@
+
+# core/output_lib.py
+from __future__ import annotations
+import json
+import os
+from pathlib import Path
+from typing import Any, Callable, Tuple, TypeVar
+
+try:
+    import orjson
+except ImportError:  # optional; fall back to the stdlib encoder
+    orjson = None
+
+T = TypeVar("T")
+
+def dumps_compact(obj: Any) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+        except TypeError:  # e.g. integers beyond 64 bits
+            pass
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def claim_unique(folder: Path, stem: str, suffix: str, create: Callable[[Path], T]) -> Tuple[Path, T]:
+    """Create folder/<stem><suffix>, or the first free <stem>_1<suffix>, <stem>_2<suffix>, ...
+
+    create must raise FileExistsError when its path is taken (Path.mkdir,
+    open(..., "xb")); returns the claimed path and what create returned.
+    """
+    # One listing of the folder instead of a stat per candidate; create then
+    # claims the name atomically, so an entry made in the meantime just moves
+    # us on to the next index
+    with os.scandir(folder) as it:
+        taken = {e.name for e in it}
+    candidate, i = folder / f"{stem}{suffix}", 0
+    while True:
+        if candidate.name not in taken:
+            try:
+                return candidate, create(candidate)
+            except FileExistsError:
+                pass
+        i += 1
+        candidate = folder / f"{stem}_{i}{suffix}"